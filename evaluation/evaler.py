@@ -51,7 +51,7 @@ class Evaler(object):
         model.eval()
         
         results = []
-        with torch.no_grad():
+        with utils.inference_mode():
             for _, (indices, gv_feat, att_feats, att_mask) in enumerate(tqdm.tqdm(self.eval_loader, desc=rname)):
                 ids = self.eval_ids[indices]
                 gv_feat = gv_feat.cuda()
@@ -33,6 +33,9 @@ __C.TRAIN.REINFORCEMENT = edict()
 
 __C.TRAIN.REINFORCEMENT.START = 30
 
+# mixed precision (torch.cuda.amp, PyTorch >= 1.6)
+__C.TRAIN.AMP = False
+
 # ---------------------------------------------------------------------------- #
 # Inference ('test') options
 # ---------------------------------------------------------------------------- #
@@ -131,6 +134,14 @@ __C.MODEL.RNN_SIZE = 1000
 
 __C.MODEL.DROPOUT_LM = 0.5
 
+# torch.compile the encoder layers (PyTorch >= 2.2, ignored otherwise)
+__C.MODEL.COMPILE = False
+
+__C.MODEL.COMPILE_MODE = 'reduce-overhead'  # 'default', 'reduce-overhead', 'max-autotune'
+
+# apex FusedLayerNorm for encoder/decoder layers (needs apex CUDA extensions, ignored with MODEL.COMPILE)
+__C.MODEL.FUSED_LAYER_NORM = False
+
 # BOTTOM_UP
 __C.MODEL.BOTTOM_UP = edict()
 
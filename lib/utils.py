@@ -8,6 +8,25 @@ from torch.autograd import Variable
 from lib.config import cfg
 from torch.nn.utils.weight_norm import weight_norm
 
+# apex 融合的 LayerNorm CUDA 实现，需同时安装其CUDA扩展（fused_layer_norm_cuda）
+try:
+    from apex.normalization import FusedLayerNorm
+    import fused_layer_norm_cuda
+except ImportError:
+    FusedLayerNorm = None
+
+def layer_norm(normalized_shape):
+    # MODEL.FUSED_LAYER_NORM 开启且 apex 可用时使用 FusedLayerNorm，否则使用 nn.LayerNorm
+    # 二者参数（weight / bias）一致，模型参数可直接互相导入
+    # apex 的 LayerNorm 对 torch.compile 不透明（会导致graph break），MODEL.COMPILE 开启时不使用
+    if cfg.MODEL.FUSED_LAYER_NORM and not cfg.MODEL.COMPILE and FusedLayerNorm is not None:
+        return FusedLayerNorm(normalized_shape)
+    return nn.LayerNorm(normalized_shape)
+
+# 推理时使用 torch.inference_mode（PyTorch >= 1.9），
+# 相比 no_grad 进一步省去 autograd 的版本计数及视图追踪开销
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 def activation(act):
     if act == 'RELU':
         return nn.ReLU(inplace=True)
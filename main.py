@@ -24,7 +24,11 @@ from evaluation.evaler import Evaler
 from scorer.scorer import Scorer
 from lib.config import cfg, cfg_from_file
 
-# from torch.cuda.amp import GradScaler, autocast
+# 混合精度训练（PyTorch >= 1.6）
+try:
+    from torch.cuda.amp import GradScaler, autocast
+except ImportError:
+    GradScaler, autocast = None, None
 
 # """
 class Trainer(object):
@@ -53,6 +57,14 @@ class Trainer(object):
             )
         self.device = torch.device("cuda")
 
+        # 混合精度训练：矩阵乘法/注意力以FP16计算，LayerNorm/softmax等仍以FP32累加
+        self.use_amp = cfg.TRAIN.AMP and autocast is not None
+        self.scaler = GradScaler(enabled=self.use_amp) if GradScaler is not None else None
+        if self.use_amp and hasattr(torch.backends.cuda, 'matmul'):
+            # 剩余的FP32矩阵乘法使用TF32（Ampere及以上GPU）
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
         # SCST标记
         self.rl_stage = False
         # 设置日志写入
@@ -422,15 +434,27 @@ class Trainer(object):
 
                     kwargs = self.make_kwargs(indices, input_seq, target_seq, gv_feat, att_feats, att_mask)
                     # 1、计算模型损失（XE训练 或 SCST训练）
-                    loss, loss_info = self.forward(kwargs)
+                    if self.use_amp:
+                        with autocast():
+                            loss, loss_info = self.forward(kwargs)
+                    else:
+                        loss, loss_info = self.forward(kwargs)
                     # 2、梯度清零（清空过往梯度）
                     self.optim.zero_grad()
-                    # 3、计算新梯度及梯度裁剪
-                    loss.backward()  # 非混合精度训练
-                    utils.clip_gradient(self.optim.optimizer, self.model,
-                        cfg.SOLVER.GRAD_CLIP_TYPE, cfg.SOLVER.GRAD_CLIP)
-                    # 4、权重更新
-                    self.optim.step() # 非混合精度训练
+                    # 3、计算新梯度及梯度裁剪，4、权重更新
+                    if self.use_amp:
+                        # 混合精度训练，梯度裁剪前需先还原梯度缩放
+                        self.scaler.scale(loss).backward()
+                        self.scaler.unscale_(self.optim.optimizer)
+                        utils.clip_gradient(self.optim.optimizer, self.model,
+                            cfg.SOLVER.GRAD_CLIP_TYPE, cfg.SOLVER.GRAD_CLIP)
+                        self.scaler.step(self.optim.optimizer)
+                        self.scaler.update()
+                    else:
+                        loss.backward()  # 非混合精度训练
+                        utils.clip_gradient(self.optim.optimizer, self.model,
+                            cfg.SOLVER.GRAD_CLIP_TYPE, cfg.SOLVER.GRAD_CLIP)
+                        self.optim.step() # 非混合精度训练
                     # 5、（XE）、优化器lr更新（用于XE训练），在SCST时不起作用
                     self.optim.scheduler_step('Iter')
 
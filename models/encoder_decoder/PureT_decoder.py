@@ -1,9 +1,14 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 from lib.config import cfg
+from lib.utils import layer_norm
+
+# PyTorch >= 2.0 提供融合的 scaled_dot_product_attention
+_FUSED_SDPA = hasattr(F, 'scaled_dot_product_attention')
     
 # 位置嵌入矩阵
 def position_embedding(input, d_model):
@@ -64,19 +69,21 @@ class Decoder(nn.Module):
                 
         self.clear_buffer()
 
-    def init_buffer(self, batch_size):
+    def init_buffer(self, batch_size, max_len=None):
+        # max_len：生成序列的最大长度，用于无梯度推理时预分配自注意力的buffer
         self.seq_len = 0
         for layer in self.layers:
-            layer.init_buffer(batch_size)
+            layer.init_buffer(batch_size, max_len)
 
     def clear_buffer(self):
         self.seq_len = None
         for layer in self.layers:
             layer.clear_buffer()
 
-    def apply_to_states(self, fn):
+    def apply_to_states(self, fn, expand=True):
+        # expand：fn 是否扩充batch（beam search 第一步 B -> B*beam_size）
         for layer in self.layers:
-            layer.apply_to_states(fn)
+            layer.apply_to_states(fn, expand)
 
     def precompute(self, encoder_out):
         p_att_feats = []
@@ -86,8 +93,20 @@ class Decoder(nn.Module):
         return p_att_feats
 
     def forward(self, gx, seq, encoder_out, seq_mask=None, att_mask=None):
+        # 0/1 掩码转换为加性偏置（0 / -1e4），所有层共享，只需计算一次，
+        # 注意力中直接与注意力得分相加后进行softmax
+        # -1e4 而非 -1e9，避免混合精度（FP16）下溢出
         if att_mask is not None:
-            att_mask = att_mask.unsqueeze(1)  # [B, 1, M]
+            if self.use_gx:
+                # cross attention 的 key / value 末尾拼接了全局特征，全局特征始终可见
+                att_mask = F.pad(att_mask, (0, 1), value=1)  # [B, M+1]
+            att_mask = ((1.0 - att_mask) * -1e4).unsqueeze(1).unsqueeze(1)  # [B, 1, 1, M(+1)]
+        if seq_mask is not None:
+            seq_mask = ((1.0 - seq_mask) * -1e4).unsqueeze(1)  # [B, 1, L, L]
+        
+        # 训练时（seq_len为None）或 inference 的第一步，cross attention 需要计算 key / value；
+        # 之后各层直接复用buffer中缓存的 key / value
+        build_kv = not self.seq_len
         
         seq_len = seq.size()[1]
         pos_indx = torch.arange(1, seq_len + 1, device='cuda').view(1, -1)
@@ -100,8 +119,17 @@ class Decoder(nn.Module):
         # [B, seq_len, C] for training or [B, 1, C] for inference
         x = self.embed_scale * self.word_embed(seq) + self.pos_embed(pos_indx)
         
+        # cross attention 的 key / value：图像特征（可包含全局特征），所有层共享，只需拼接一次
+        # [B, M+1, C] or [B, M, C]
+        if not build_kv:
+            kv = None
+        elif self.use_gx:
+            kv = torch.cat([encoder_out, gx.unsqueeze(1)], 1)
+        else:
+            kv = encoder_out
+        
         for layer in self.layers:
-            x = layer(gx, x, encoder_out, seq_mask, att_mask)
+            x = layer(gx, x, kv, seq_mask, att_mask)
 
         x = self.dropout(x)
         out = self.generator(x)
@@ -114,63 +142,77 @@ class DecoderLayer(nn.Module):
             embed_dim = embed_dim, 
             num_heads = num_heads
         )
-        self.layer_norm1 = nn.LayerNorm(embed_dim)
+        self.layer_norm1 = layer_norm(embed_dim)
 
+        # 图像特征在逐词推理过程中保持不变，其 key / value 只需计算一次
         self.cross_att = MultiHeadSelfAttention(
             embed_dim = embed_dim, 
-            num_heads = num_heads
+            num_heads = num_heads,
+            static_kv = True
         )
-        self.layer_norm2 = nn.LayerNorm(embed_dim)
+        self.layer_norm2 = layer_norm(embed_dim)
 
         self.ff_layer = FeedForward(
             embed_dim = embed_dim, 
             ffn_embed_dim = embed_dim * 4, 
             relu_dropout = ff_dropout
         )
-        self.layer_norm3 = torch.nn.LayerNorm(embed_dim)
+        self.layer_norm3 = layer_norm(embed_dim)
         
         self.dropout = nn.Dropout(dropout)
         
         self.use_gx = use_gx
         if self.use_gx:
             # 方式2，concat接Linear / Linear+GLU
-            self.fuse_layer = nn.Sequential(
-                nn.Linear(embed_dim*2, embed_dim),
-                nn.ReLU(),
-                nn.Dropout(0.1)
-            )
-            self.fuse_layer_norm = nn.LayerNorm(embed_dim)
-	    
+            # Linear([x; gx]) = Linear_x(x) + Linear_gx(gx)，拆分后无需拼接 [B, L, 2C] 的张量，
+            # 且 gx 在序列维度上相同，只需对 [B, C] 做一次变换再广播
+            self.fuse_x = nn.Linear(embed_dim, embed_dim)
+            self.fuse_gx = nn.Linear(embed_dim, embed_dim, bias=False)
+            self.fuse_act = nn.ReLU(inplace=True)
+            self.fuse_dropout = nn.Dropout(0.1)
+            self.fuse_layer_norm = layer_norm(embed_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧版本模型参数：将 fuse_layer 的 [C, 2C] 权重拆分为 fuse_x / fuse_gx
+        if prefix + 'fuse_layer.0.weight' in state_dict:
+            weight = state_dict.pop(prefix + 'fuse_layer.0.weight')
+            embed_dim = weight.size(0)
+            state_dict[prefix + 'fuse_x.weight'] = weight[:, :embed_dim]
+            state_dict[prefix + 'fuse_gx.weight'] = weight[:, embed_dim:]
+            state_dict[prefix + 'fuse_x.bias'] = state_dict.pop(prefix + 'fuse_layer.0.bias')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def apply_to_states(self, fn):
-        self.word_attn.apply_to_states(fn)
+    def apply_to_states(self, fn, expand=True):
+        self.word_attn.apply_to_states(fn, expand)
+        self.cross_att.apply_to_states(fn, expand)
 
-    def init_buffer(self, batch_size):
-        self.word_attn.init_buffer(batch_size)
+    def init_buffer(self, batch_size, max_len=None):
+        self.word_attn.init_buffer(batch_size, max_len)
+        self.cross_att.init_buffer(batch_size)
 
     def clear_buffer(self):
         self.word_attn.clear_buffer()
+        self.cross_att.clear_buffer()
 
     def precompute(self, encoder_out):
         # key, value2 = self.cross_att.precompute(encoder_out, encoder_out)
         # return key, value2
         pass
 
-    def forward(self, gx, x, encoder_out, seq_mask, att_mask=None):
+    def forward(self, gx, x, kv, seq_mask, att_mask=None):
         # 单词嵌入自注意力
         # short_cut = x
         # 在单词嵌入自注意力阶段，嵌入图像的全局特征
         # 方式2:concat接Linear+GLU / Linear
         if self.use_gx:
-            x_cat = torch.cat([x, gx.unsqueeze(1).expand_as(x)], dim=-1)
-            x = self.fuse_layer(x_cat) + x
+            x_fuse = self.fuse_x(x) + self.fuse_gx(gx).unsqueeze(1)
+            x = self.fuse_dropout(self.fuse_act(x_fuse)) + x
             x = self.fuse_layer_norm(x)
         short_cut = x
         
         x = self.word_attn(
             q = x,
-            k = x,
-            v = x,
+            kv = x,
             mask = seq_mask
         )
         x = self.dropout(x)
@@ -178,24 +220,12 @@ class DecoderLayer(nn.Module):
 
         # 单词嵌入与图像特征（可包含全局特征）cross 注意力
         short_cut = x
-        if self.use_gx:
-            kv = torch.cat([encoder_out, gx.unsqueeze(1)], 1)
-            if att_mask is not None:
-                # [B, 1, M+1]，对于grid特征，直接设置为None亦可
-                _att_mask = torch.cat(
-                    [att_mask, torch.ones(att_mask.size(0), device='cuda').unsqueeze(1).unsqueeze(1)], 2
-                ).long()
-            else:
-                _att_mask = None
-        else:
-            kv = encoder_out
-            _att_mask = att_mask
-            
+        # kv 已在Decoder中拼接全局特征 [B, M+1, C]，inference 第一步之后为None（使用缓存的 key / value），
+        # att_mask 已在Decoder中扩充为 [B, 1, 1, M+1]，对于grid特征，直接设置为None亦可
         x = self.cross_att(
             q = x,
-            k = kv,
-            v = kv,
-            mask = _att_mask,
+            kv = kv,
+            mask = att_mask,
             # precompute=False
         )
         x = self.dropout(x)
@@ -210,69 +240,130 @@ class DecoderLayer(nn.Module):
         return x
     
 class MultiHeadSelfAttention(nn.Module):
-    def __init__(self, embed_dim=512, num_heads=8):
+    def __init__(self, embed_dim=512, num_heads=8, static_kv=False):
         super().__init__()
         self.embed_dim = embed_dim
         self.num_heads = num_heads
         self.head_dim = self.embed_dim // self.num_heads
         self.scale = self.head_dim ** -0.5
+        # static_kv=True 时（cross attention），inference 时 key / value 只在第一步计算，
+        # 之后直接复用buffer；否则（单词嵌入自注意力）每一步追加到buffer末尾
+        self.static_kv = static_kv
         
         self.q_linear = nn.Linear(embed_dim, embed_dim)
-        self.k_linear = nn.Linear(embed_dim, embed_dim)
-        self.v_linear = nn.Linear(embed_dim, embed_dim)
+        # k / v 来自同一输入，两个线性变换合并为一个Linear，仅需一次GEMM
+        self.kv_linear = nn.Linear(embed_dim, embed_dim * 2)
         self.o_linear = nn.Linear(embed_dim, embed_dim)
         
         self.softmax = nn.Softmax(-1)
         
         self.clear_buffer()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧版本模型参数：将 k_linear / v_linear 合并为 kv_linear
+        if prefix + 'k_linear.weight' in state_dict:
+            for name in ('weight', 'bias'):
+                state_dict[prefix + 'kv_linear.' + name] = torch.cat(
+                    [state_dict.pop(prefix + _l + '_linear.' + name) for _l in ('k', 'v')], 0
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         
-    def init_buffer(self, batch_size):
-        # [B, nH, 0, C/nH]
-        self.buffer_key = torch.zeros((batch_size, self.num_heads, 0, self.head_dim), device='cuda')
-        self.buffer_value = torch.zeros((batch_size, self.num_heads, 0, self.head_dim), device='cuda')
+    def init_buffer(self, batch_size, max_len=None):
+        # 无梯度推理时，自注意力预分配 [B, nH, max_len, C/nH] 的buffer，每一步原地写入，
+        # 避免每一步重新分配并拷贝之前所有的 key / value；
+        # 仅 greedy / sample 解码受益，beam search 每一步仍需重排（拷贝）已写入的部分
+        # SCST采样时需保留计算图，不能原地写入，与 cross attention 一样使用 [B, nH, 0, C/nH] 的buffer逐步拼接
+        self.preallocated = not self.static_kv and max_len is not None and not torch.is_grad_enabled()
+        buffer_len = max_len if self.preallocated else 0
+        self.buffer_key = torch.zeros((batch_size, self.num_heads, buffer_len, self.head_dim), device='cuda')
+        self.buffer_value = torch.zeros((batch_size, self.num_heads, buffer_len, self.head_dim), device='cuda')
+        # buffer中已写入的长度
+        self.buffer_len = 0
         
     def clear_buffer(self):
         self.buffer_key = None
         self.buffer_value = None
+        self.buffer_len = 0
+        self.preallocated = False
         
-    def apply_to_states(self, fn):
-        self.buffer_key = fn(self.buffer_key)
-        self.buffer_value = fn(self.buffer_value)
+    def apply_to_states(self, fn, expand=True):
+        if self.static_kv and not expand:
+            # cross attention 的 key / value 只与图像相关，同一图像的各个beam完全相同，
+            # 仅在batch扩充时需要处理，beam重排无需拷贝
+            return
+        if self.preallocated:
+            # 预分配的buffer只需重排已写入的部分，未写入的位置无需拷贝
+            key = fn(self.buffer_key[:, :, :self.buffer_len])
+            value = fn(self.buffer_value[:, :, :self.buffer_len])
+            if key.size(0) != self.buffer_key.size(0):
+                # beam search 第一步之后batch由 B 扩充为 B*beam_size，需重新分配buffer
+                self.buffer_key = key.new_zeros((key.size(0),) + self.buffer_key.shape[1:])
+                self.buffer_value = value.new_zeros((value.size(0),) + self.buffer_value.shape[1:])
+            self.buffer_key[:, :, :self.buffer_len] = key
+            self.buffer_value[:, :, :self.buffer_len] = value
+        else:
+            self.buffer_key = fn(self.buffer_key)
+            self.buffer_value = fn(self.buffer_value)
     
-    def forward(self, q, k, v, mask):
+    def forward(self, q, kv, mask):
         """
         Decoder部分有两部分进行注意力：
-            1）单词嵌入自注意力，q/k/v大小均为[B, L, D]
+            1）单词嵌入自注意力，q/kv大小均为[B, L, D]
             2）单词嵌入与图像特征（包含全局特征）的cross attention，q的大小为[B, L, D]
-               k/v的大小为[B, M+1, D]
+               kv的大小为[B, M+1, D]
+        mask为加性偏置（0 / -1e4），大小为[B, 1, L, L]或[B, 1, 1, M+1]
         输出的维度大小只与q的维度大小相关
         """
         B_, N, C = q.size()
         # 线性变换
         q = self.q_linear(q).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        k = self.k_linear(k).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        v = self.v_linear(v).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
         
-        # 存储buffer，用于inference时单词嵌入自注意力
-        if self.buffer_key is not None and self.buffer_value is not None:
-            self.buffer_key = torch.cat([self.buffer_key, k], dim=2)
-            self.buffer_value = torch.cat([self.buffer_value, v], dim=2)
+        # cross attention 在 inference 时，第一步之后直接复用buffer中的 key / value
+        if self.static_kv and self.buffer_key is not None and self.buffer_key.size(2) > 0:
             k = self.buffer_key
             v = self.buffer_value
+        else:
+            # [2, B, nH, L, C/nH]
+            kv = self.kv_linear(kv).view(B_, -1, 2, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+            k, v = kv[0], kv[1]
+            
+            # 存储buffer，用于inference
+            if self.buffer_key is not None and self.buffer_value is not None:
+                if not self.preallocated:
+                    self.buffer_key = torch.cat([self.buffer_key, k], dim=2)
+                    self.buffer_value = torch.cat([self.buffer_value, v], dim=2)
+                    k = self.buffer_key
+                    v = self.buffer_value
+                else:
+                    end = self.buffer_len + k.size(2)
+                    assert end <= self.buffer_key.size(2), \
+                        'decoding exceeds the preallocated buffer length %d' % self.buffer_key.size(2)
+                    self.buffer_key[:, :, self.buffer_len:end] = k
+                    self.buffer_value[:, :, self.buffer_len:end] = v
+                    self.buffer_len = end
+                    k = self.buffer_key[:, :, :end]
+                    v = self.buffer_value[:, :, :end]
             
         # 注意力核心操作
-        # [B, nH, L, L] or [B, nH, L, M+1]
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        
-        # 计算注意力权重
-        if mask is not None:
-            mask = mask.unsqueeze(1)
-            attn = attn.masked_fill(mask == 0, -1e9)
-            attn = self.softmax(attn)
+        if _FUSED_SDPA:
+            # 融合的注意力计算（FlashAttention / Memory-Efficient），
+            # 不显式生成 [B, nH, L, L] 的注意力矩阵，缩放系数默认为 head_dim ** -0.5
+            out = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=None if mask is None else mask.to(q.dtype)
+            )
         else:
+            # [B, nH, L, L] or [B, nH, L, M+1]
+            # 缩放系数作用在q上，避免对注意力矩阵再做一次逐元素乘法
+            q = q * self.scale
+            attn = q @ k.transpose(-2, -1)
+
+            # 计算注意力权重，加性掩码与softmax之间无需额外的 masked_fill
+            if mask is not None:
+                attn = attn + mask
             attn = self.softmax(attn)
-            
-        out = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+            out = attn @ v
+
+        out = out.transpose(1, 2).reshape(B_, N, C)
         out = self.o_linear(out)
         return out
     
@@ -281,7 +372,7 @@ class FeedForward(nn.Module):
     def __init__(self, embed_dim, ffn_embed_dim, relu_dropout = 0.1):
         super().__init__()
         self.fc1 = nn.Linear(embed_dim, ffn_embed_dim)
-        self.act = nn.ReLU()
+        self.act = nn.ReLU(inplace=True)
         self.fc2 = nn.Linear(ffn_embed_dim, embed_dim)
         self.dropout = nn.Dropout(relu_dropout)
     
@@ -4,6 +4,15 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 import torch.nn.functional as F
 
+from lib.utils import layer_norm
+
+def _mark_dynamic(x, dim):
+    # 大小为0/1的维度会被 torch.compile 特化为常量，标记为动态时 mark_dynamic 会报错，直接跳过
+    if x.size(dim) < 2:
+        return
+    import torch._dynamo
+    torch._dynamo.mark_dynamic(x, dim)
+
 # 加入全局特征共同处理
 class Encoder(nn.Module):
     def __init__(
@@ -41,13 +50,25 @@ class Encoder(nn.Module):
                 use_gx=use_gx
             ) for i in range(self.depth)
         ])
+        # 是否已使用 torch.compile 编译各层，见 compile_layers
+        self.compiled = False
+    
+    def compile_layers(self, mode='default'):
+        # 原地编译各编码器层（PyTorch >= 2.2），不改变模型参数名称
+        # fullgraph=True：整层编译为单个静态图，不允许graph break（不回退到eager执行）；
+        # 网格/窗口/特征尺寸均为常量，按静态形状特化，'max-autotune' 模式下可针对固定尺寸搜索最优kernel；
+        # 仅 batch 维度在 forward 中标记为动态，避免不同batch大小各自触发重新编译
+        for layer in self.layers:
+            layer.compile(mode=mode, fullgraph=True)
+        self.compiled = True
     
     def forward(self, x, att_mask=None):
         # x: [B, H*W, C]
         # 对于grid特征，att mask为None亦可
         # 全局特征初始化，图像特征均值 [B, C]
+        # 掩码加权求和用一次 bmm 完成（[B, 1, M] @ [B, M, C]），不生成 [B, M, C] 的中间张量
         if att_mask is not None:
-            gx = (torch.sum(x * att_mask.unsqueeze(-1), 1) / torch.sum(att_mask.unsqueeze(-1), 1))
+            gx = torch.bmm(att_mask.unsqueeze(1).type_as(x), x).squeeze(1) / att_mask.sum(-1, keepdim=True)
         else:
             gx = x.mean(1)
         
@@ -59,6 +80,9 @@ class Encoder(nn.Module):
             
         # 核心操作层
         for layer in self.layers:
+            if self.compiled:
+                # 训练 / 验证 / 最后一个batch 的大小各不相同，batch 维度按动态尺寸编译
+                _mark_dynamic(O, 0)
             O = layer(O, att_mask)
         
         if self.use_gx:
@@ -114,7 +138,7 @@ class EncoderLayer(nn.Module):
         )
         # dropout同时用于encoder_attn和ff_layer输出
         self.dropout = nn.Dropout(dropout) 
-        self.layer_norm1 = nn.LayerNorm(embed_dim)
+        self.layer_norm1 = layer_norm(embed_dim)
         
         # 构造FeedForward层
         ffn_embed_dim = int(embed_dim * mlp_ratio)
@@ -123,7 +147,7 @@ class EncoderLayer(nn.Module):
             ffn_embed_dim = ffn_embed_dim, 
             relu_dropout = dropout
         )
-        self.layer_norm2 = nn.LayerNorm(embed_dim)
+        self.layer_norm2 = layer_norm(embed_dim)
 
         # 此处mask为SW-MSA使用
         # [nW, w_s * w_s, w_s * w_s]
@@ -284,7 +308,7 @@ class FeedForward(nn.Module):
     def __init__(self, embed_dim, ffn_embed_dim, relu_dropout = 0.1):
         super().__init__()
         self.fc1 = nn.Linear(embed_dim, ffn_embed_dim)
-        self.act = nn.ReLU()    # ReLU / GELU / CELU
+        self.act = nn.ReLU(inplace=True)    # ReLU / GELU / CELU
         self.fc2 = nn.Linear(ffn_embed_dim, embed_dim)
         self.dropout = nn.Dropout(relu_dropout)
     
@@ -337,13 +361,21 @@ class WindowAttention(nn.Module):
         
         trunc_normal_(self.relative_position_bias_table, std=.02)
         
-        self.q_linear = nn.Linear(embed_dim, embed_dim)
-        self.k_linear = nn.Linear(embed_dim, embed_dim)
-        self.v_linear = nn.Linear(embed_dim, embed_dim)
+        # q/k/v 三个线性变换合并为一个Linear，仅需一次GEMM
+        self.qkv = nn.Linear(embed_dim, embed_dim * 3)
         self.o_linear = nn.Linear(embed_dim, embed_dim)
 
         self.softmax = nn.Softmax(dim=-1)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧版本模型参数：将 q_linear / k_linear / v_linear 合并为 qkv
+        if prefix + 'q_linear.weight' in state_dict:
+            for name in ('weight', 'bias'):
+                state_dict[prefix + 'qkv.' + name] = torch.cat(
+                    [state_dict.pop(prefix + _l + '_linear.' + name) for _l in ('q', 'k', 'v')], 0
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -359,10 +391,10 @@ class WindowAttention(nn.Module):
         print('raw all', x.min(), x.max(), x.mean())
         # """
         
-        # [B*nW, nH, N, C//nH]，其中nW为window数量，nH为num_heads
-        q = self.q_linear(x).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        k = self.k_linear(x).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        v = self.v_linear(x).view(B_, -1, self.num_heads, self.head_dim).transpose(1, 2)
+        # [3, B*nW, nH, N, C//nH]，其中nW为window数量，nH为num_heads
+        qkv = self.qkv(x).view(B_, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        # [B*nW, nH, N, C//nH]
+        q, k, v = qkv[0], qkv[1], qkv[2]
         
         """
         print('gx q', q[:, :, -1, :].min(), q[:, :, -1, :].max(), q[:, :, -1, :].mean())
@@ -374,7 +406,9 @@ class WindowAttention(nn.Module):
         # """
         
         # [B*nW, nH, N, N]，其中nW为window数量，nH为num_heads
-        attn = (q @ k.transpose(-2, -1)) * self.scale
+        # 缩放系数作用在q上（[N, C//nH]），而非注意力矩阵（[N, N]）上
+        q = q * self.scale
+        attn = q @ k.transpose(-2, -1)
         # print(attn.min(), attn.max(), attn.mean())
 
         # 相对位置编码，仅window区域内的grid特征之间计算
@@ -439,10 +473,12 @@ class WindowAttention(nn.Module):
             # [B, nH, 1]
             gx_attn_2 = gx_attn[:, :, -1:] 
             # [B, nH, 1] --> [B, nH, nW, 1] --> [B, nW, nH, 1] --> [B*nW, nH, 1]
-            gx_attn_2 = gx_attn_2.unsqueeze(-1).repeat(1, 1, self.nW, 1).permute(0, 2, 1, 3).contiguous().view(B_, self.num_heads, -1)
-            # [B*nW, nH, N] --> [B*nW, nH, 1, N]
-            gx_attn = torch.cat([gx_attn_1, gx_attn_2], -1).unsqueeze(-2)
-            gx = (gx_attn @ v).transpose(1, 2).reshape(B_, C)
+            gx_attn_2 = gx_attn_2.unsqueeze(-1).expand(-1, -1, self.nW, -1).permute(0, 2, 1, 3).contiguous().view(B_, self.num_heads, -1)
+            # [B*nW, nH, N]
+            gx_attn = torch.cat([gx_attn_1, gx_attn_2], -1)
+            # 加权求和直接按 N 维度收缩，无需为 matmul 构造大小为1的维度
+            # [B*nW, nH, N] x [B*nW, nH, N, C//nH] --> [B*nW, nH, C//nH] --> [B*nW, C]
+            gx = torch.einsum('bhn,bhnd->bhd', gx_attn, v).reshape(B_, C)
             # print(gx.size())
             gx = gx.view(B_ // self.nW, self.nW, -1).sum(1)
             # print(gx.size())
@@ -75,6 +75,11 @@ class PureT(BasicModel):
             use_gx = use_gx
         )
         
+        # 编码器层输入尺寸固定，使用 torch.compile 融合层内的小算子（ReLU/LayerNorm/softmax等），
+        # 减少kernel启动及Python调度开销；原地编译，不改变模型参数名称
+        if cfg.MODEL.COMPILE and hasattr(nn.Module, 'compile'):
+            self.encoder.compile_layers(cfg.MODEL.COMPILE_MODE)
+        
         self.decoder = Decoder(
             vocab_size = self.vocab_size, 
             embed_dim = cfg.MODEL.BILINEAR.DIM, 
@@ -170,7 +175,7 @@ class PureT(BasicModel):
         # kwargs[cfg.PARAM.P_ATT_FEATS] = p_att_feats
 
         outputs = []
-        self.decoder.init_buffer(batch_size)
+        self.decoder.init_buffer(batch_size, cfg.MODEL.SEQ_LEN)
         for t in range(cfg.MODEL.SEQ_LEN):
             cur_beam_size = 1 if t == 0 else beam_size
 
@@ -198,7 +203,10 @@ class PureT(BasicModel):
             selected_words = selected_idx - selected_beam * candidate_logprob.shape[-1]
 
             # update buffer
-            self.decoder.apply_to_states(self._expand_state(batch_size, beam_size, cur_beam_size, selected_beam))
+            self.decoder.apply_to_states(
+                self._expand_state(batch_size, beam_size, cur_beam_size, selected_beam),
+                expand = cur_beam_size != beam_size
+            )
             seq_logprob = selected_logprob.unsqueeze(-1)
             seq_mask = torch.gather(seq_mask, 1, selected_beam.unsqueeze(-1))
             outputs = list(torch.gather(o, 1, selected_beam.unsqueeze(-1)) for o in outputs)
@@ -257,7 +265,7 @@ class PureT(BasicModel):
         att_feats = self.att_embed(att_feats)
         gx, encoder_out = self.encoder(att_feats, att_mask)
         # p_att_feats = self.decoder.precompute(encoder_out)
-        self.decoder.init_buffer(batch_size)
+        self.decoder.init_buffer(batch_size, cfg.MODEL.SEQ_LEN)
         
         state = None
         sents = Variable(torch.zeros((batch_size, cfg.MODEL.SEQ_LEN), dtype=torch.long).cuda())